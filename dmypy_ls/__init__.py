@@ -20,18 +20,29 @@
 # DEALINGS IN THE SOFTWARE.
 
 import argparse
+import concurrent.futures
+import functools
 import io
 import logging
+import multiprocessing
 import os
 import re
+import stat
+import subprocess
+import tempfile
+import threading
 import time
 import traceback
 import typing
+import urllib.parse
 from contextlib import redirect_stderr, redirect_stdout
 
 from lsprotocol import types
+from mypy import build as mypy_build
+from mypy import defaults as mypy_defaults
 from mypy import dmypy_server
 from mypy import main as mypy_main
+from mypy.errors import CompileError
 from mypy.find_sources import SourceFinder
 from mypy.fscache import FileSystemCache
 from mypy.modulefinder import BuildSource
@@ -63,6 +74,12 @@ MYPY_OUTPUT_RE = re.compile(
     """,
     re.VERBOSE,
 )
+ValidateParams = (
+    types.DidOpenTextDocumentParams
+    | types.DidChangeTextDocumentParams
+    | types.DidSaveTextDocumentParams
+)
+
 MYPY_SEVERITY = {
     "error": types.DiagnosticSeverity.Error,
     "warning": types.DiagnosticSeverity.Warning,
@@ -70,11 +87,71 @@ MYPY_SEVERITY = {
 }
 
 
+@functools.lru_cache(maxsize=4096)
+def _range(line: int, col: int) -> types.Range:
+    # lsprotocol models are validated on creation, positions repeat a lot
+    return types.Range(
+        start=types.Position(line=line, character=col),
+        end=types.Position(line=line, character=col + 1),
+    )
+
+
+def _is_number(value: str) -> bool:
+    if value[:1] in ("-", "+"):
+        value = value[1:]
+    return value.isdecimal()
+
+
+def _find_lines(text: str, marker: str, max_offset: int) -> typing.Iterator[str]:
+    # Only slices the lines having marker near their start
+    pos = text.find(marker)
+    while pos != -1:
+        start = text.rfind("\n", 0, pos) + 1
+        end = text.find("\n", pos)
+        if end == -1:
+            end = len(text)
+        if pos + len(marker) - start <= max_offset:
+            yield text[start:end]
+        pos = text.find(marker, end)
+
+
+# file, row, col, severity, message, code
+MypyLine = tuple[str, str, str | None, str, str, str | None]
+
+
+def _parse_mypy_line(line: str) -> MypyLine | None:
+    # Plain str methods are much faster, MYPY_OUTPUT_RE is the fallback
+    location, sep, rest = line.partition(": ")
+    severity, sep_severity, message = rest.partition(": ")
+    parts = location.split(":")
+    if (
+        sep and sep_severity and severity and ":" not in severity
+        and 2 <= len(parts) <= 3
+        and parts[0] and all(_is_number(p) for p in parts[1:])
+    ):
+        code = None
+        if message.endswith("]"):
+            text, sep_code, maybe_code = message[:-1].rpartition("  [")
+            if sep_code and maybe_code and "]" not in maybe_code:
+                message, code = text, maybe_code
+        col = parts[2] if len(parts) == 3 else None
+        return parts[0], parts[1], col, severity, message, code
+
+    m = MYPY_OUTPUT_RE.match(line)
+    if m is None:
+        return None
+    return typing.cast(
+        MypyLine, m.group("file", "row", "col", "severity", "message", "code"),
+    )
+
+
 class MypyServer(server.LanguageServer):
     def __init__(self) -> None:
         super().__init__("dmypy", "v0.2")
         self._debug = False
-        self._use_dmypy = False
+        self._use_dmypy = True
+        # mypy isn't reentrant, validations hold it and check() takes it again
+        self._check_lock = threading.RLock()
 
         self._flags = [
             "--hide-error-context",
@@ -85,179 +162,614 @@ class MypyServer(server.LanguageServer):
             "--no-pretty",
         ]
 
+        self._mtime_bump = 0
+        self._untitled_paths: dict[str, str] = {}
+        self._scratch_dir: tempfile.TemporaryDirectory[str] | None = None
+        # filepath -> (module name, base dir), reset when files are created/moved
+        self._crawl_cache: dict[str, tuple[str, str]] = {}
+        # path -> text of every document validated so far, checked together
+        self._documents: dict[str, str | None] = {}
+
+        # didChange comes on each keystroke, only the last one is checked
+        self._debounce_delay = 0.05
+        self._pending_validations: dict[str, threading.Timer] = {}
+        self._pending_lock = threading.Lock()
+        # didOpen comes for each visible file, they are checked in a single run
+        self._batch_delay = 0.01
+        self._batch: dict[str, tuple[ValidateParams, int]] = {}
+        self._batch_timer: threading.Timer | None = None
+        # uri -> generation of the last validation scheduled
+        self._validation_generations: dict[str, int] = {}
+
+        # uri -> (path, mypy output lines, diagnostics) of the last publication
+        self._published: dict[
+            str, tuple[str, tuple[str, ...], list[types.Diagnostic]],
+        ] = {}
+        self._published_max_size = 128
+
         self.is_tty = False
         self.terminal_width=80
 
-    def setup(self, debug: bool, use_dmypy: bool = False, virtualenv: str | None = None) -> None:
+    def setup(
+        self, debug: bool, use_dmypy: bool = True, virtualenv: str | None = None,
+        worker_process: bool = True,
+    ) -> None:
         self._debug = debug
         self._use_dmypy = use_dmypy
-
-        LOG.info("Initializing mypy options")
+        self._virtualenv = virtualenv
+        self._worker_process = worker_process
 
         self.fscache = FileSystemCache()
+        self._fscache_ttl = 5.0
+        self._fscache_flushed_at = time.monotonic()
+        self.load_options()
+
+        self._worker_pool: concurrent.futures.ProcessPoolExecutor | None = None
+        if self._worker_process:
+            self.start_worker()
+
+    def start_worker(self) -> None:
+        # mypy holds the GIL, a worker process keeps the JSON-RPC loop responsive
+        LOG.info("Starting mypy worker process")
+        self._worker_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self._debug, self._use_dmypy, self._virtualenv),
+        )
+        # Spawn it now, so its start-up overlaps the LSP handshake
+        self._worker_pool.submit(_warm_up_worker)
+
+    def stop_worker(self) -> None:
+        if self._worker_pool is not None:
+            self._worker_pool.shutdown(wait=False, cancel_futures=True)
+            self._worker_pool = None
+
+    def load_options(self) -> None:
+        LOG.info("Initializing mypy options")
 
         _, self.options = mypy_main.process_options(
             self._flags, fscache=self.fscache,
             require_targets=False, server_options=self._use_dmypy,
         )
+        self._config_mtimes = self.get_config_mtimes()
+        self._last_check: tuple[
+            tuple[tuple[str | None, str | None], ...], dict[str, typing.Any],
+        ] | None = None
 
-        if virtualenv:
+        if self._virtualenv:
             # NOTE(sileht): This works only if no mypy plugins are used due to:
             # https://github.com/python/mypy/issues/12575
             # The best is to install dmypy-ls in the virtualenv and run it from there
-            self.options.python_executable = f"{virtualenv}/bin/python"
+            self.options.python_executable = f"{self._virtualenv}/bin/python"
+
+        # With a worker process, options here only resolve module names
+        if (
+            not self._worker_process
+            and self.options.cache_dir == os.path.expanduser(mypy_defaults.CACHE_DIR)
+        ):
+            # Per workspace and git branch, kept across restarts
+            self.options.cache_dir = self.get_cache_dir()
+            # The daemon metastore is used from several threads, sqlite forbids it
+            self.options.sqlite_cache = not self._use_dmypy
 
         self.finder = SourceFinder(self.fscache, self.options)
+        self._crawl_cache.clear()
 
-        if self._use_dmypy:
-            # FIXME(sileht): not ready yet, crash on second check with
-            # https://github.com/python/mypy/issues/14645
+        if self._use_dmypy and not self._worker_process:
+            # Otherwise the server disables the cache written by the first check
+            self.options.use_fine_grained_cache = True
             self.server = dmypy_server.Server(
                 options=self.options,
                 status_file="dmypy-ls-not-used-status-file",
             )
-            self.options.use_fine_grained_cache = True
 
             # Use our fscache
             self.server.fscache = self.fscache
 
-            LOG.info("Initializing fined grain cache")
-            res = self.server.initialize_fine_grained([], self.is_tty, self.terminal_width)
-            self.server.flush_caches()
-            self.server.update_stats(res)
+            # Built by the first check: https://github.com/python/mypy/issues/14645
+
+    def get_cache_dir(self) -> str:
+        workspace_root = os.getcwd()
+        try:
+            branch = subprocess.run(
+                ["git", "rev-parse", "--abbrev-ref", "HEAD"],
+                cwd=workspace_root, capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            branch = ""
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        return os.path.join(
+            cache_home,
+            "dmypy-ls",
+            hash_digest(workspace_root.encode())[:16],
+            branch.replace(os.sep, "_") or "default",
+        )
+
+    def get_config_mtimes(self) -> tuple[int | None, ...]:
+        # All candidates are watched, so a config file created later is found
+        mtimes: list[int | None] = []
+        for config_file in (self.options.config_file, *mypy_defaults.CONFIG_FILES):
+            if config_file is None:
+                continue
+            try:
+                mtimes.append(os.stat(os.path.expanduser(config_file)).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def refresh(self) -> None:
+        if self.get_config_mtimes() != self._config_mtimes:
+            LOG.info("mypy config file changed, reloading options")
+            self.load_options()
+
+        # Flushed from time to time, edited files are refreshed by _inject_buffer()
+        now = time.monotonic()
+        if now - self._fscache_flushed_at > self._fscache_ttl:
+            self.fscache.flush()
+            self._fscache_flushed_at = now
+            # Files may have changed on disk
+            self._last_check = None
+
+    def check(self, sources: list[BuildSource]) -> dict[str, typing.Any]:
+        if self._worker_pool is not None:
+            return self.check_in_worker(sources)
+
+        with self._check_lock:
+            self.refresh()
+
+            # didChange and didSave often come with the same content
+            buffers = [
+                None if source.text is None else source.text.encode()
+                for source in sources
+            ]
+            digests = [
+                None if encoded is None else hash_digest(encoded)
+                for encoded in buffers
+            ]
+            cache_key = tuple(
+                (source.path, digest)
+                for source, digest in zip(sources, digests, strict=True)
+            )
+            if self._last_check is not None and self._last_check[0] == cache_key:
+                LOG.debug(
+                    "%s unchanged since last check",
+                    [source.path for source in sources],
+                )
+                return self._last_check[1]
+
+            for source, encoded, digest in zip(sources, buffers, digests, strict=True):
+                if source.path and encoded is not None and digest is not None:
+                    self._inject_buffer(source.path, encoded, digest)
+
+            if self._use_dmypy:
+                res = self.check_with_dmypy(sources)
+            else:
+                res = self.check_with_mypy(sources)
+
+            self._last_check = (cache_key, res)
+            return res
+
+    def check_in_worker(self, sources: list[BuildSource]) -> dict[str, typing.Any]:
+        assert self._worker_pool is not None
+        # BuildSource is compiled by mypyc and can't be pickled
+        future = self._worker_pool.submit(
+            _check_in_worker,
+            [(s.path, s.module, s.text, s.base_dir) for s in sources],
+        )
+        try:
+            return future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            LOG.error("mypy worker process died, restarting it")
+            self.stop_worker()
+            self.start_worker()
+            raise
+
+    def _inject_buffer(self, path: str, encoded: bytes, digest: str) -> None:
+        # Served from the fscache, --shadow-file would restart the daemon
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            mode, mtime = stat.S_IFREG | 0o644, 0.0
+        else:
+            mode, mtime = st.st_mode, st.st_mtime
+
+        # The daemon only rehashes files whose size or mtime changed
+        self._mtime_bump += 1
+        self.fscache.stat_cache[path] = os.stat_result(
+            (mode, 0, 0, 1, os.getuid(), os.getgid(), len(encoded),
+             mtime, mtime + self._mtime_bump, mtime),
+        )
+        self.fscache.read_cache[path] = encoded
+        # Compared with the cache metadata, it must be mypy's hash_digest()
+        self.fscache.hash_cache[path] = digest
 
-    def check(self, source: BuildSource) -> dict[str, typing.Any]:
-        self.fscache.flush()
-        if source.path and source.text:
-            self.fscache.stat(source.path)
-            self.fscache.read_cache[source.path] = source.text.encode()
-            self.fscache.hash_cache[source.path] = hash_digest(source.text.encode())
+        # Ensure the import resolver sees the file even if it's not on disk yet
+        dirname, basename = os.path.split(path)
+        try:
+            names = self.fscache.listdir(dirname)
+        except OSError:
+            names = []
+        if basename not in names:
+            self.fscache.listdir_cache[dirname] = [*names, basename]
+
+    def _path(self, uri: str) -> str:
+        if uri.startswith("file://"):
+            # Clients percent-encode paths with spaces or non ascii chars
+            return os.path.normpath(urllib.parse.unquote(uri[7:]))
+        return self._untitled_path(uri)
+
+    def _untitled_path(self, uri: str) -> str:
+        # Stable path in an empty private directory, nothing is written there
+        if uri not in self._untitled_paths:
+            if self._scratch_dir is None:
+                self._scratch_dir = tempfile.TemporaryDirectory(prefix="dmypy-ls-")
+            self._untitled_paths[uri] = os.path.join(
+                self._scratch_dir.name,
+                f"untitled_{hash_digest(uri.encode())[:16]}.py",
+            )
+        return self._untitled_paths[uri]
 
-        if self._use_dmypy:
-            return self.check_with_dmypy(source)
+    def check_with_mypy(self, sources: list[BuildSource]) -> dict[str, typing.Any]:
+        # run_build() would also format and print all the messages
+        messages: list[str] = []
 
-        return self.check_with_mypy(source)
+        def flush_errors(new_messages: list[str], _serious: bool) -> None:
+            messages.extend(new_messages)
 
-    def check_with_mypy(self, source: BuildSource) -> dict[str, typing.Any]:
         stderr = io.StringIO()
         stdout = io.StringIO()
         with redirect_stderr(stderr):
             with redirect_stdout(stdout):
-                t0 = time.time()
-                mypy_main.run_build([source], self.options, self.fscache, t0, stdout, stderr)
-
-        return {"out": stdout.getvalue(), "err": stderr.getvalue(), "status": 0}
-
-    def check_with_dmypy(self, source: BuildSource) -> dict[str, typing.Any]:
-        if not self.server.following_imports():
-            messages = self.server.fine_grained_increment([source])
+                try:
+                    mypy_build.build(
+                        sources, self.options, None, flush_errors,
+                        self.fscache, stdout, stderr,
+                    )
+                except CompileError:
+                    # Blocking errors have already been flushed
+                    pass
+
+        out = "".join(f"{message}\n" for message in messages)
+        return {"out": out, "err": stderr.getvalue(), "status": 0}
+
+    def check_with_dmypy(self, sources: list[BuildSource]) -> dict[str, typing.Any]:
+        # Same as Server.check() without flushing our fscache
+        if not self.server.fine_grained_manager:
+            res = self.server.initialize_fine_grained(
+                self._write_fine_grained_cache(sources),
+                self.is_tty, self.terminal_width,
+            )
         else:
-            messages = self.server.fine_grained_increment_follow_imports([source])
-        res = self.server.increment_output(messages, [source], self.is_tty, self.terminal_width)
-        self.server.flush_caches()
+            if not self.server.following_imports():
+                messages = self.server.fine_grained_increment(sources)
+            else:
+                messages = self.server.fine_grained_increment_follow_imports(sources)
+            res = self.server.increment_output(
+                messages, sources, self.is_tty, self.terminal_width,
+            )
+        if self.server.fine_grained_manager:
+            self.server.fine_grained_manager.flush_cache()
         self.server.update_stats(res)
         return res
 
-    def validate(
-        self,
-        params: (types.DidOpenTextDocumentParams|
-            types.DidChangeTextDocumentParams|
-            types.DidSaveTextDocumentParams),
-    ) -> None:
-        started_at = time.monotonic()
-        try:
-            text_doc = self.workspace.get_document(params.text_document.uri)
-            if text_doc.uri.startswith("file://"):
-                filepath = os.path.normpath(text_doc.uri[7:])
-                name, base_dir = self.finder.crawl_up(filepath)
-                source = BuildSource(filepath, name, text_doc.source, base_dir)
-            else:
-                source = BuildSource(None, None, text_doc.source)
-            res = self.check(source)
-        except:
-            res = {"out": "", "err": traceback.format_exc(), "status": 2}
-
-        elapsed = time.monotonic() - started_at
+    def _write_fine_grained_cache(
+        self, sources: list[BuildSource],
+    ) -> list[BuildSource]:
+        # The daemon never writes its cache, a regular build does
+        options = self.options.apply_changes({
+            "fine_grained_incremental": False,
+            "use_fine_grained_cache": False,
+            "cache_fine_grained": True,
+        })
+        stderr = io.StringIO()
+        stdout = io.StringIO()
+        with redirect_stderr(stderr):
+            with redirect_stdout(stdout):
+                try:
+                    result = mypy_build.build(
+                        sources, options, None, lambda *_: None,
+                        self.fscache, stdout, stderr,
+                    )
+                except CompileError:
+                    # Blocking errors, the daemon reports them
+                    return sources
+        # Imported modules stay followed, or silenced ones would be rechecked
+        modules = {source.module for source in sources}
+        return sources + [
+            BuildSource(state.path, module, followed=True)
+            for module, state in result.graph.items()
+            if module not in modules
+        ]
 
-        LOG.info(f"{source.path} checked in {elapsed}s)")
-        self.publish_result_to_diagnostic(text_doc.uri, res, elapsed)
+    def validate(self, params: ValidateParams) -> None:
+        with self._pending_lock:
+            generation = self._next_generation(params.text_document.uri)
+        self.validate_many([(params, generation)])
+
+    def _next_generation(self, uri: str) -> int:
+        # Must be called with _pending_lock held
+        generation = self._validation_generations.get(uri, 0) + 1
+        self._validation_generations[uri] = generation
+        return generation
+
+    def _is_superseded(self, uri: str, generation: int) -> bool:
+        with self._pending_lock:
+            return self._validation_generations[uri] != generation
+
+    def validate_many(self, scheduled: list[tuple[ValidateParams, int]]) -> None:
+        # A newer validation may be scheduled while waiting for the slot
+        with self._check_lock:
+            uris = [
+                params.text_document.uri
+                for params, generation in scheduled
+                if not self._is_superseded(params.text_document.uri, generation)
+            ]
+            if not uris:
+                LOG.debug(
+                    "%s superseded by newer changes",
+                    [params.text_document.uri for params, _ in scheduled],
+                )
+                return
+            generations = {
+                params.text_document.uri: generation for params, generation in scheduled
+            }
+
+            started_at = time.monotonic()
+            paths: list[str | None] = [None] * len(uris)
+            try:
+                # Module names are resolved with the options of this process
+                self.refresh()
+                for i, uri in enumerate(uris):
+                    filepath = paths[i] = self._path(uri)
+                    source = self.workspace.get_document(uri).source
+                    with self._pending_lock:
+                        self._documents[filepath] = source
+                with self._pending_lock:
+                    documents = list(self._documents.items())
+                sources = []
+                for filepath, text in documents:
+                    crawled = self._crawl_cache.get(filepath)
+                    if crawled is None:
+                        crawled = self.finder.crawl_up(filepath)
+                        self._crawl_cache[filepath] = crawled
+                    name, base_dir = crawled
+                    sources.append(BuildSource(filepath, name, text, base_dir))
+                res = self.check(sources)
+            except:
+                res = {"out": "", "err": traceback.format_exc(), "status": 2}
+
+            elapsed = time.monotonic() - started_at
+
+            LOG.debug("%s checked in %ss", paths, elapsed)
+            # The output covers all the sources, each document keeps its own lines
+            for uri, path in zip(uris, paths, strict=True):
+                if self._is_superseded(uri, generations[uri]):
+                    # Changed during the check, the next validation publishes
+                    continue
+                self.publish_result_to_diagnostic(uri, path, res, elapsed)
+
+    def validate_soon(self, params: ValidateParams) -> None:
+        uri = params.text_document.uri
+        with self._pending_lock:
+            self._batch[uri] = (params, self._next_generation(uri))
+            if self._batch_timer is None:
+                self._batch_timer = threading.Timer(
+                    self._batch_delay, self._validate_batch,
+                )
+                self._batch_timer.start()
+
+    def _validate_batch(self) -> None:
+        with self._pending_lock:
+            batch = list(self._batch.values())
+            self._batch.clear()
+            self._batch_timer = None
+        if batch:
+            self.validate_many(batch)
+
+    def forget_documents(self, uris: list[str]) -> None:
+        with self._pending_lock:
+            for uri in uris:
+                if uri.startswith("file://"):
+                    self._documents.pop(self._path(uri), None)
+                else:
+                    path = self._untitled_paths.pop(uri, None)
+                    if path is not None:
+                        self._documents.pop(path, None)
+                self._published.pop(uri, None)
+
+    def invalidate_crawl_cache(self) -> None:
+        LOG.info("Workspace files changed, dropping module names cache")
+        self._crawl_cache.clear()
+
+    def validate_later(self, params: types.DidChangeTextDocumentParams) -> None:
+        uri = params.text_document.uri
+        with self._pending_lock:
+            # A queued didOpen/didSave is superseded by this change
+            self._batch.pop(uri, None)
+            timer = self._pending_validations.get(uri)
+            if timer is not None:
+                timer.cancel()
+            timer = threading.Timer(
+                self._debounce_delay, self._validate_pending,
+                (params, self._next_generation(uri)),
+            )
+            self._pending_validations[uri] = timer
+            timer.start()
 
-    def publish_result_to_diagnostic(self, uri: str, res: dict[str, typing.Any], elapsed: float) -> None:
-        if self._debug or res["err"] or res["status"] != 0:
+    def _validate_pending(
+        self, params: types.DidChangeTextDocumentParams, generation: int,
+    ) -> None:
+        uri = params.text_document.uri
+        with self._pending_lock:
+            if self._pending_validations.get(uri) is threading.current_thread():
+                del self._pending_validations[uri]
+        # validate_many() skips it if it was cancelled too late
+        self.validate_many([(params, generation)])
+
+    def publish_result_to_diagnostic(
+        self, uri: str, path: str | None, res: dict[str, typing.Any], elapsed: float,
+    ) -> None:
+        # The daemon exits with 1 on type errors, that's not a failure
+        if self._debug or res["err"] or res["status"] not in (0, 1):
             LOG.info(f"Ran mypy in {elapsed}s:")
             LOG.info(f"* uri: {uri}")
             LOG.info(f"* result: {res}")
         
-        diagnostics = []
-        for line in res["out"].splitlines():
-            m = MYPY_OUTPUT_RE.match(line)
-            if m is None:
-                LOG.info(f"fail to parse mypy result: {line}")
+        diagnostics: list[types.Diagnostic] = []
+        if path is None:
+            self.publish_diagnostics(uri, diagnostics)
+            return
+
+        # Reported file names are a suffix of path
+        marker = f"{os.path.basename(path)}:"
+        marker_end = len(path) + 1
+        lines = tuple(_find_lines(res["out"], marker, marker_end))
+
+        published = self._published.get(uri)
+        if published is not None and published[:2] == (path, lines):
+            self.publish_diagnostics(uri, published[2])
+            return
+
+        for line in lines:
+            parsed = _parse_mypy_line(line)
+            if parsed is None:
+                continue
+            filename, row, col_str, severity, message, code = parsed
+            if not path.endswith(filename):
+                continue
+
+            code_line = int(row)
+            if col_str is None:
+                col = 1
             else:
-                data = typing.cast(MypyRegexResult, m.groupdict())
-                if not uri.endswith(data["file"]):
-                    continue
-
-                code_line = int(data["row"])
-                if data["col"] is None:
-                    col = 1
-                else:
-                    col = int(data["col"])
-                d = types.Diagnostic(
-                    range=types.Range(
-                        start=types.Position(line=code_line - 1, character=col - 1),
-                        end=types.Position(line=code_line - 1, character=col),
-                    ),
-                    message=data["message"],
-                    code=data["code"],
-                    severity=MYPY_SEVERITY[data["severity"]],
-                    source="dmypy-ls",
-                )
-                diagnostics.append(d)
+                col = int(col_str)
+            d = types.Diagnostic(
+                range=_range(code_line - 1, col - 1),
+                message=message,
+                code=code,
+                # Unknown severities aren't dropped
+                severity=MYPY_SEVERITY.get(
+                    severity, types.DiagnosticSeverity.Information,
+                ),
+                source="dmypy-ls",
+            )
+            diagnostics.append(d)
 
+        self._published.pop(uri, None)
+        if len(self._published) >= self._published_max_size:
+            self._published.pop(next(iter(self._published)), None)
+        self._published[uri] = (path, lines, diagnostics)
         self.publish_diagnostics(uri, diagnostics)
 
 
+_worker: MypyServer | None = None
+
+
+def _init_worker(debug: bool, use_dmypy: bool, virtualenv: str | None) -> None:
+    # The worker inherits the JSON-RPC stdout
+    os.dup2(2, 1)
+    logging.basicConfig(
+        level=logging.DEBUG if debug else logging.INFO,
+        format="%(asctime)s %(levelname)-8s worker: %(message)s",
+    )
+    global _worker
+    _worker = MypyServer()
+    _worker.setup(debug, use_dmypy, virtualenv, worker_process=False)
+
+
+def _warm_up_worker() -> None:
+    assert _worker is not None
+
+
+def _check_in_worker(
+    sources: list[tuple[str | None, str | None, str | None, str | None]],
+) -> dict[str, typing.Any]:
+    assert _worker is not None
+    return _worker.check([BuildSource(*source) for source in sources])
+
+
 ls = MypyServer()
 
 
-@ls.thread()
 @ls.feature(types.TEXT_DOCUMENT_DID_OPEN)
 def did_open(self: MypyServer, params: types.DidOpenTextDocumentParams) -> None:
-    LOG.info(f"DidOpen received {params.text_document.uri}")
-    self.validate(params)
+    LOG.debug("DidOpen received %s", params.text_document.uri)
+    self.validate_soon(params)
 
 
-@ls.thread()
 @ls.feature(types.TEXT_DOCUMENT_DID_CHANGE)
 def did_change(self: MypyServer, params: types.DidChangeTextDocumentParams) -> None:
-    LOG.info(f"Didchange received {params.text_document.uri}")
-    self.validate(params)
+    LOG.debug("Didchange received %s", params.text_document.uri)
+    self.validate_later(params)
 
 
-@ls.thread()
 @ls.feature(types.TEXT_DOCUMENT_DID_SAVE)
 def did_save(self: MypyServer, params: types.DidSaveTextDocumentParams) -> None:
-    LOG.info(f"DidSave received {params.text_document.uri}")
-    self.validate(params)
+    LOG.debug("DidSave received %s", params.text_document.uri)
+    self.validate_soon(params)
+
+
+@ls.feature(types.TEXT_DOCUMENT_DID_CLOSE)
+def did_close(self: MypyServer, params: types.DidCloseTextDocumentParams) -> None:
+    LOG.debug("DidClose received %s", params.text_document.uri)
+    self.forget_documents([params.text_document.uri])
+
+
+FILE_OPERATIONS_OPTIONS = types.FileOperationRegistrationOptions(
+    filters=[types.FileOperationFilter(pattern=types.FileOperationPattern(glob="**"))],
+)
+
+
+@ls.feature(types.WORKSPACE_DID_CREATE_FILES, FILE_OPERATIONS_OPTIONS)
+def did_create_files(self: MypyServer, params: types.CreateFilesParams) -> None:
+    LOG.debug("DidCreateFiles received %s", [f.uri for f in params.files])
+    self.invalidate_crawl_cache()
+
+
+@ls.feature(types.WORKSPACE_DID_DELETE_FILES, FILE_OPERATIONS_OPTIONS)
+def did_delete_files(self: MypyServer, params: types.DeleteFilesParams) -> None:
+    LOG.debug("DidDeleteFiles received %s", [f.uri for f in params.files])
+    self.forget_documents([f.uri for f in params.files])
+    self.invalidate_crawl_cache()
+
+
+@ls.feature(types.WORKSPACE_DID_RENAME_FILES, FILE_OPERATIONS_OPTIONS)
+def did_rename_files(self: MypyServer, params: types.RenameFilesParams) -> None:
+    LOG.debug("DidRenameFiles received %s", [f.old_uri for f in params.files])
+    self.forget_documents([f.old_uri for f in params.files])
+    self.invalidate_crawl_cache()
 
 
 def main() -> None:
+    parser = argparse.ArgumentParser(description="super fast mypy language server")
+    parser.add_argument(
+        "--debug", action="store_true",
+        default=bool(os.environ.get("DMYPY_LS_DEBUG")),
+    )
+    parser.add_argument("--chdir", default="/")
+    parser.add_argument("--no-daemon", action="store_true")
+    # The daemon is the default now, kept for existing editor configs
+    parser.add_argument(
+        "--dmypy-experimental", action="store_true", help=argparse.SUPPRESS,
+    )
+    parser.add_argument("--no-worker-process", action="store_true")
+    parser.add_argument("--virtualenv")
+    args = parser.parse_args()
     logging.basicConfig(
         filename="/Users/sileht/pygls.log",
         filemode="w",
-        level=logging.INFO,
+        level=logging.DEBUG if args.debug else logging.INFO,
         format="%(asctime)s %(levelname)-8s %(message)s",
     )
     logging.getLogger("pygls").setLevel(logging.ERROR)
-    parser = argparse.ArgumentParser(description="super fast mypy language server")
-    parser.add_argument("--debug", action="store_true")
-    parser.add_argument("--chdir", default="/")
-    parser.add_argument("--dmypy-experimental", action="store_true")
-    parser.add_argument("--virtualenv")
-    args = parser.parse_args()
     LOG.info("chdir into %s", args.chdir)
     os.chdir(args.chdir)
-    ls.setup(args.debug, args.dmypy_experimental, args.virtualenv)
+    ls.setup(
+        args.debug, not args.no_daemon, args.virtualenv, not args.no_worker_process,
+    )
     LOG.info("start io loop")
-    ls.start_io()
+    try:
+        ls.start_io()
+    finally:
+        ls.stop_worker()
@@ -19,8 +19,12 @@
 # DEALINGS IN THE SOFTWARE.
 
 import logging
+import os
+import pathlib
 import sys
 import tempfile
+import threading
+import time
 import typing
 from unittest import mock
 
@@ -61,20 +65,42 @@ foo(5)
 class ServerFixture(typing.NamedTuple):
     server: dmypy_ls.MypyServer
     fake_publish_diagnostics: mock.Mock
+    timers: list[threading.Timer]
+
+@pytest.fixture(scope="session")
+def cache_home(tmp_path_factory: pytest.TempPathFactory) -> pathlib.Path:
+    # Shared between tests so typeshed is only checked once
+    return tmp_path_factory.mktemp("cache")
+
 
 @pytest.fixture(params=("mypy", "dmypy"))
-def server(fake_document: workspace.Document, request: pytest.FixtureRequest) -> ServerFixture:
-    if request.param == "dmypy":
-        pytest.skip()
+def server(
+    fake_document: workspace.Document, request: pytest.FixtureRequest,
+    cache_home: pathlib.Path, monkeypatch: pytest.MonkeyPatch,
+) -> ServerFixture:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_home))
+    timers: list[threading.Timer] = []
+
+    class RecordedTimer(threading.Timer):
+        def start(self) -> None:
+            timers.append(self)
+            super().start()
 
+    monkeypatch.setattr(threading, "Timer", RecordedTimer)
     fake_publish_diagnostics = mock.Mock()
     s = dmypy_ls.MypyServer()
-    s.setup(False, request.param == "dmypy")
+    s.setup(False, request.param == "dmypy", worker_process=False)
     s.lsp.workspace = workspace.Workspace("", None)  # type: ignore[no-untyped-call]
     s.lsp.workspace.get_document = mock.Mock(return_value=fake_document)  # type: ignore[method-assign]
     s.lsp.transport = mock.Mock()
     s.publish_diagnostics = fake_publish_diagnostics  # type: ignore[method-assign]
-    return ServerFixture(s, fake_publish_diagnostics)
+    return ServerFixture(s, fake_publish_diagnostics, timers)
+
+
+def _wait_pending_validations(server: ServerFixture) -> None:
+    # Validations run in the timer threads, including timers started meanwhile
+    while server.timers:
+        server.timers.pop().join()
 
 
 def _assert_diags(diags: list[types.Diagnostic]) -> None:
@@ -92,6 +118,18 @@ def _assert_diags(diags: list[types.Diagnostic]) -> None:
     assert diags[1].severity == types.DiagnosticSeverity.Error
 
 
+def test_cache_options(server: ServerFixture) -> None:
+    options = server.server.options
+    if server.server._use_dmypy:
+        # The daemon metastore is used from several threads
+        assert not options.sqlite_cache
+        assert options.local_partial_types
+    else:
+        assert options.sqlite_cache
+        # Same errors as a plain mypy run
+        assert not options.local_partial_types
+
+
 def test_did_save(
     server: ServerFixture, fake_document: workspace.Document,
 ) -> None:
@@ -103,10 +141,60 @@ def test_did_save(
     )
 
     dmypy_ls.did_save(server.server, params)
+    _wait_pending_validations(server)
     server.fake_publish_diagnostics.assert_called_once()
     _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
 
 
+def test_did_save_unchanged(
+    server: ServerFixture, fake_document: workspace.Document,
+) -> None:
+    params = types.DidSaveTextDocumentParams(
+        text_document=types.TextDocumentIdentifier(
+            uri=fake_document.uri,
+        ),
+    )
+
+    dmypy_ls.did_save(server.server, params)
+    _wait_pending_validations(server)
+    with mock.patch.object(
+        server.server, "check_with_mypy",
+    ) as check_with_mypy, mock.patch.object(
+        server.server, "check_with_dmypy",
+    ) as check_with_dmypy:
+        dmypy_ls.did_save(server.server, params)
+        _wait_pending_validations(server)
+    check_with_mypy.assert_not_called()
+    check_with_dmypy.assert_not_called()
+    assert server.fake_publish_diagnostics.call_count == 2
+    _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
+    first, second = server.fake_publish_diagnostics.call_args_list
+    assert first[0][1] is second[0][1]
+
+
+def test_did_save_unchanged_after_fscache_flush(
+    server: ServerFixture, fake_document: workspace.Document,
+) -> None:
+    params = types.DidSaveTextDocumentParams(
+        text_document=types.TextDocumentIdentifier(
+            uri=fake_document.uri,
+        ),
+    )
+
+    dmypy_ls.did_save(server.server, params)
+    _wait_pending_validations(server)
+    # Files on disk may have changed since the fscache was flushed
+    server.server._fscache_ttl = 0
+    method = "check_with_dmypy" if server.server._use_dmypy else "check_with_mypy"
+    with mock.patch.object(
+        server.server, method, wraps=getattr(server.server, method),
+    ) as check:
+        dmypy_ls.did_save(server.server, params)
+        _wait_pending_validations(server)
+    check.assert_called_once()
+    _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
+
+
 def test_did_open(
     server: ServerFixture, fake_document: workspace.Document,
 ) -> None:
@@ -120,10 +208,92 @@ def test_did_open(
     )
 
     dmypy_ls.did_open(server.server, params)
+    _wait_pending_validations(server)
     server.fake_publish_diagnostics.assert_called_once()
     _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
 
 
+def test_did_open_batch(
+    server: ServerFixture, fake_document: workspace.Document,
+    tmp_path: pathlib.Path,
+) -> None:
+    other_path = tmp_path / "other.py"
+    other_path.write_text("x: int = 1\n")
+    other_doc = workspace.Document(f"file://{other_path}", "x: int = 1\n")
+    documents = {fake_document.uri: fake_document, other_doc.uri: other_doc}
+    server.server.lsp.workspace.get_document = mock.Mock(side_effect=documents.get)
+
+    with mock.patch.object(
+        server.server, "check", wraps=server.server.check,
+    ) as check:
+        for doc in (fake_document, other_doc):
+            dmypy_ls.did_open(
+                server.server,
+                types.DidOpenTextDocumentParams(
+                    text_document=types.TextDocumentItem(
+                        uri=doc.uri, language_id="python", version=1, text=doc.source,
+                    ),
+                ),
+            )
+        _wait_pending_validations(server)
+
+    check.assert_called_once()
+    assert len(check.call_args[0][0]) == 2
+    published = {
+        call[0][0]: call[0][1]
+        for call in server.fake_publish_diagnostics.call_args_list
+    }
+    assert published.keys() == documents.keys()
+    _assert_diags(published[fake_document.uri])
+    assert published[other_doc.uri] == []
+
+
+def test_documents_checked_together(
+    server: ServerFixture, fake_document: workspace.Document,
+    tmp_path: pathlib.Path,
+) -> None:
+    other_path = tmp_path / "other.py"
+    other_path.write_text("x: int = 1\n")
+    other_doc = workspace.Document(f"file://{other_path}", "x: int = 1\n")
+    documents = {fake_document.uri: fake_document, other_doc.uri: other_doc}
+    server.server.lsp.workspace.get_document = mock.Mock(side_effect=documents.get)
+
+    with mock.patch.object(
+        server.server, "check", wraps=server.server.check,
+    ) as check:
+        for doc in (fake_document, other_doc):
+            dmypy_ls.did_save(
+                server.server,
+                types.DidSaveTextDocumentParams(
+                    text_document=types.TextDocumentIdentifier(uri=doc.uri),
+                ),
+            )
+            _wait_pending_validations(server)
+        # Only the saved document is published
+        published = [
+            call[0][0] for call in server.fake_publish_diagnostics.call_args_list
+        ]
+        assert published == [fake_document.uri, other_doc.uri]
+        assert [s.path for s in check.call_args[0][0]] == [
+            fake_document.uri[7:], str(other_path),
+        ]
+
+        dmypy_ls.did_close(
+            server.server,
+            types.DidCloseTextDocumentParams(
+                text_document=types.TextDocumentIdentifier(uri=fake_document.uri),
+            ),
+        )
+        dmypy_ls.did_save(
+            server.server,
+            types.DidSaveTextDocumentParams(
+                text_document=types.TextDocumentIdentifier(uri=other_doc.uri),
+            ),
+        )
+        _wait_pending_validations(server)
+    assert [s.path for s in check.call_args[0][0]] == [str(other_path)]
+
+
 def test_did_change(
     server: ServerFixture, fake_document: workspace.Document,
 ) -> None:
@@ -135,6 +305,7 @@ def test_did_change(
         ),
     )
     dmypy_ls.did_change(server.server, params)
+    _wait_pending_validations(server)
     server.fake_publish_diagnostics.assert_called_once()
     _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
 
@@ -157,10 +328,296 @@ foo("foo")
     )
     server.fake_publish_diagnostics.reset_mock()
     dmypy_ls.did_change(server.server, params)
+    _wait_pending_validations(server)
     server.fake_publish_diagnostics.assert_called_once()
     assert len(server.fake_publish_diagnostics.call_args[0][1]) == 0
 
 
+def test_did_change_debounce(
+    server: ServerFixture, fake_document: workspace.Document,
+) -> None:
+    params = types.DidChangeTextDocumentParams(
+        content_changes=[],
+        text_document=types.VersionedTextDocumentIdentifier(
+            version=1,
+            uri=fake_document.uri,
+        ),
+    )
+    for _ in range(5):
+        dmypy_ls.did_change(server.server, params)
+    _wait_pending_validations(server)
+    server.fake_publish_diagnostics.assert_called_once()
+    _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
+
+
+def test_did_open_superseded_by_change(
+    server: ServerFixture, fake_document: workspace.Document,
+) -> None:
+    dmypy_ls.did_open(
+        server.server,
+        types.DidOpenTextDocumentParams(
+            text_document=types.TextDocumentItem(
+                uri=fake_document.uri,
+                language_id="python",
+                version=1,
+                text=fake_document.source,
+            ),
+        ),
+    )
+    dmypy_ls.did_change(
+        server.server,
+        types.DidChangeTextDocumentParams(
+            content_changes=[],
+            text_document=types.VersionedTextDocumentIdentifier(
+                version=2,
+                uri=fake_document.uri,
+            ),
+        ),
+    )
+    _wait_pending_validations(server)
+    server.fake_publish_diagnostics.assert_called_once()
+    _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
+
+
+def test_did_change_superseded(
+    server: ServerFixture, fake_document: workspace.Document,
+) -> None:
+    def params(version: int) -> types.DidChangeTextDocumentParams:
+        return types.DidChangeTextDocumentParams(
+            content_changes=[],
+            text_document=types.VersionedTextDocumentIdentifier(
+                version=version, uri=fake_document.uri,
+            ),
+        )
+
+    get_document = mock.Mock(return_value=fake_document)
+    server.server.lsp.workspace.get_document = get_document
+    check = server.server.check
+
+    def slow_check(sources: list[typing.Any]) -> dict[str, typing.Any]:
+        if check_mock.call_count == 1:
+            # Version 2 waits for the check slot while version 3 is scheduled
+            dmypy_ls.did_change(server.server, params(2))
+            time.sleep(0.5)
+            dmypy_ls.did_change(server.server, params(3))
+        return check(sources)
+
+    with mock.patch.object(
+        server.server, "check", side_effect=slow_check,
+    ) as check_mock:
+        dmypy_ls.did_change(server.server, params(1))
+        _wait_pending_validations(server)
+
+    # Versions 1 and 3 are checked, only version 3 is published
+    assert check_mock.call_count == 2
+    assert get_document.call_count == 2
+    server.fake_publish_diagnostics.assert_called_once()
+    _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
+
+
+def test_did_open_worker_process(
+    server: ServerFixture, fake_document: workspace.Document,
+) -> None:
+    server.server.start_worker()
+    params = types.DidOpenTextDocumentParams(
+        text_document=types.TextDocumentItem(
+            uri=fake_document.uri,
+            language_id="python",
+            version=1,
+            text=fake_document.source,
+        ),
+    )
+
+    try:
+        dmypy_ls.did_open(server.server, params)
+        _wait_pending_validations(server)
+    finally:
+        server.server.stop_worker()
+    server.fake_publish_diagnostics.assert_called_once()
+    _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
+
+
+def test_config_change_worker_process(
+    server: ServerFixture, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    config = tmp_path / "mypy.ini"
+    config.write_text("[mypy]\n")
+    module = tmp_path / "pkg" / "mod.py"
+    module.parent.mkdir()
+    module.write_text("x: int = 1\n")
+    doc = workspace.Document(f"file://{module}", "x: int = 1\n")
+    server.server.lsp.workspace.get_document = mock.Mock(return_value=doc)
+    params = types.DidSaveTextDocumentParams(
+        text_document=types.TextDocumentIdentifier(uri=doc.uri),
+    )
+
+    server.server.start_worker()
+    try:
+        with mock.patch.object(
+            server.server, "check_in_worker",
+            return_value={"out": "", "err": "", "status": 0},
+        ) as check_in_worker:
+            dmypy_ls.did_save(server.server, params)
+            _wait_pending_validations(server)
+            (source,) = check_in_worker.call_args[0][0]
+            assert source.module == "mod"
+
+            config.write_text("[mypy]\nexplicit_package_bases = True\n")
+            mtime = config.stat().st_mtime_ns + 1_000_000_000
+            os.utime(config, ns=(mtime, mtime))
+            dmypy_ls.did_save(server.server, params)
+            _wait_pending_validations(server)
+            (source,) = check_in_worker.call_args[0][0]
+            assert source.module == "pkg.mod"
+    finally:
+        server.server.stop_worker()
+
+
+def test_config_file_created(
+    server: ServerFixture, fake_document: workspace.Document,
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    params = types.DidSaveTextDocumentParams(
+        text_document=types.TextDocumentIdentifier(uri=fake_document.uri),
+    )
+    with mock.patch.object(
+        server.server, "check", return_value={"out": "", "err": "", "status": 0},
+    ):
+        dmypy_ls.did_save(server.server, params)
+        _wait_pending_validations(server)
+        assert not server.server.options.warn_unreachable
+
+        (tmp_path / "mypy.ini").write_text("[mypy]\nwarn_unreachable = True\n")
+        dmypy_ls.did_save(server.server, params)
+        _wait_pending_validations(server)
+        assert server.server.options.warn_unreachable
+
+
+def test_did_delete_files(
+    server: ServerFixture, fake_document: workspace.Document,
+) -> None:
+    params = types.DidSaveTextDocumentParams(
+        text_document=types.TextDocumentIdentifier(
+            uri=fake_document.uri,
+        ),
+    )
+    dmypy_ls.did_save(server.server, params)
+    _wait_pending_validations(server)
+    assert server.server._crawl_cache
+
+    dmypy_ls.did_delete_files(
+        server.server,
+        types.DeleteFilesParams(files=[types.FileDelete(uri=fake_document.uri)]),
+    )
+    assert not server.server._crawl_cache
+
+
+def test_did_open_untitled(
+    server: ServerFixture, fake_document: workspace.Document,
+) -> None:
+    untitled_doc = workspace.Document("untitled:Untitled-1", fake_document.source)
+    server.server.lsp.workspace.get_document = mock.Mock(return_value=untitled_doc)
+    params = types.DidOpenTextDocumentParams(
+        text_document=types.TextDocumentItem(
+            uri=untitled_doc.uri,
+            language_id="python",
+            version=1,
+            text=untitled_doc.source,
+        ),
+    )
+
+    dmypy_ls.did_open(server.server, params)
+    _wait_pending_validations(server)
+    server.fake_publish_diagnostics.assert_called_once()
+    assert server.fake_publish_diagnostics.call_args[0][0] == untitled_doc.uri
+    _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
+
+
+def test_did_open_quoted_uri(
+    server: ServerFixture, fake_document: workspace.Document,
+    tmp_path: pathlib.Path,
+) -> None:
+    path = tmp_path / "with space.py"
+    path.write_text(fake_document.source)
+    doc = workspace.Document(f"file://{tmp_path}/with%20space.py", fake_document.source)
+    server.server.lsp.workspace.get_document = mock.Mock(return_value=doc)
+    params = types.DidOpenTextDocumentParams(
+        text_document=types.TextDocumentItem(
+            uri=doc.uri, language_id="python", version=1, text=doc.source,
+        ),
+    )
+
+    dmypy_ls.did_open(server.server, params)
+    _wait_pending_validations(server)
+    server.fake_publish_diagnostics.assert_called_once()
+    _assert_diags(server.fake_publish_diagnostics.call_args[0][1])
+    assert str(path) in server.server._crawl_cache
+
+
+def test_publish_result_to_diagnostic_other_files(server: ServerFixture) -> None:
+    out = (
+        'pkg/other.py:1:1: error: Name "x" is not defined  [name-defined]\n'
+        'pkg/mod.py:2:5: error: Name "y" is not defined  [name-defined]\n'
+        "pkg/othermod.py:3:1: note: Not the right module\n"
+    )
+    server.server.publish_result_to_diagnostic(
+        "file:///src/pkg/mod.py", "/src/pkg/mod.py",
+        {"out": out, "err": "", "status": 1}, 0,
+    )
+    server.fake_publish_diagnostics.assert_called_once()
+    diags = server.fake_publish_diagnostics.call_args[0][1]
+    assert [d.message for d in diags] == ['Name "y" is not defined']
+
+
+def test_publish_result_to_diagnostic_other_files_changed(
+    server: ServerFixture,
+) -> None:
+    line = 'pkg/mod.py:2:5: error: Name "y" is not defined  [name-defined]\n'
+    for other in ("", 'pkg/other.py:1:1: error: Name "x" is not defined\n'):
+        server.server.publish_result_to_diagnostic(
+            "file:///src/pkg/mod.py", "/src/pkg/mod.py",
+            {"out": other + line, "err": "", "status": 1}, 0,
+        )
+    first, second = server.fake_publish_diagnostics.call_args_list
+    assert first[0][1] is second[0][1]
+
+
+def test_publish_result_to_diagnostic_unknown_severity(server: ServerFixture) -> None:
+    out = (
+        "pkg/mod.py:1:1: hint: Something new\n"
+        'pkg/mod.py:2:5: error: Name "y" is not defined  [name-defined]\n'
+    )
+    server.server.publish_result_to_diagnostic(
+        "file:///src/pkg/mod.py", "/src/pkg/mod.py",
+        {"out": out, "err": "", "status": 1}, 0,
+    )
+    diags = server.fake_publish_diagnostics.call_args[0][1]
+    assert [d.severity for d in diags] == [
+        types.DiagnosticSeverity.Information,
+        types.DiagnosticSeverity.Error,
+    ]
+
+
+def test_publish_result_to_diagnostic_quiet(
+    server: ServerFixture, caplog: pytest.LogCaptureFixture,
+) -> None:
+    caplog.set_level(logging.INFO, logger="dmypy_ls")
+    out = 'pkg/mod.py:2:5: error: Name "y" is not defined  [name-defined]\n'
+    server.server.publish_result_to_diagnostic(
+        "file:///src/pkg/mod.py", "/src/pkg/mod.py",
+        {"out": out, "err": "", "status": 1}, 0,
+    )
+    assert "* result:" not in caplog.text
+
+    server.server.publish_result_to_diagnostic(
+        "file:///src/pkg/mod.py", "/src/pkg/mod.py",
+        {"out": "", "err": "Traceback", "status": 2}, 0,
+    )
+    assert "* result:" in caplog.text
+
+
 @pytest.mark.parametrize(
     "message,expected",
     [
@@ -209,3 +666,24 @@ def test_output_parser(message: str, expected: dmypy_ls.MypyRegexResult) -> None
     ret = dmypy_ls.MYPY_OUTPUT_RE.match(message)
     assert ret is not None
     assert ret.groupdict() == expected
+    assert dmypy_ls._parse_mypy_line(message) == (
+        expected["file"],
+        expected["row"],
+        expected["col"],
+        expected["severity"],
+        expected["message"],
+        expected["code"],
+    )
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "Success: no issues found in 1 source file",
+        "foo.py: error: no line number",
+        "foo.py:12:a: error: bad column",
+        "",
+    ],
+)
+def test_output_parser_invalid(line: str) -> None:
+    assert dmypy_ls._parse_mypy_line(line) is None